@@ -1,16 +1,25 @@
 import os
 import logging
-from datetime import datetime
+import math
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from typing import List, Optional
 
-from fastapi import FastAPI, HTTPException, Path # type: ignore
+import anyio # type: ignore
+import orjson # type: ignore
+from fastapi import Depends, FastAPI, HTTPException, Path, Query, Response # type: ignore
 from fastapi.middleware.cors import CORSMiddleware  # type: ignore
-from pydantic import BaseModel, Field, condecimal # type: ignore
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime # type: ignore
+from fastapi.responses import ORJSONResponse, StreamingResponse # type: ignore
+from starlette.background import BackgroundTask # type: ignore
+from pydantic import BaseModel, ConfigDict, Field # type: ignore
+from sqlalchemy import Column, Integer, String, Float, DateTime, Index, delete, func, insert, select, text # type: ignore
+from sqlalchemy.engine import make_url # type: ignore
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine # type: ignore
 from sqlalchemy.orm import sessionmaker # type: ignore
 from sqlalchemy.ext.declarative import declarative_base # type: ignore
 from prometheus_fastapi_instrumentator import Instrumentator # type: ignore
-from fastapi.encoders import jsonable_encoder # type: ignore
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess # type: ignore
 
 # --- Configuração de Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,16 +28,26 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 HOURLY_RATE = float(os.getenv("HOURLY_RATE", 50.0))
 FRONTEND_URL = os.getenv("FRONTEND_URL")
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Desative quando o schema for aplicado fora da aplicação, antes de subir os workers
+DB_AUTO_CREATE = os.getenv("DB_AUTO_CREATE", "true").lower() in ("1", "true", "yes")
 
 if not DATABASE_URL:
     logging.error("Variável de ambiente DATABASE_URL não definida.")
     raise ValueError("DATABASE_URL é necessária para a conexão com o banco de dados.")
 
 # --- Configuração da Aplicação FastAPI ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await init_db()
+    yield
+    await engine.dispose()
+
 app = FastAPI(
     title="API de Cálculo de Valor por Tarefa",
     description="Calcula o valor de tarefas com base no tempo e persiste os dados.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # --- Habilitar CORS (com segurança para produção) ---
@@ -48,33 +67,112 @@ app.add_middleware(
 )
 
 # --- Configuração do Banco de Dados ---
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Driver assíncrono (asyncpg) para não bloquear o event loop durante o I/O com o banco
+# (protocolo binário e executemany em lote). Aceita postgres://, postgresql:// ou postgresql+psycopg2://;
+# o ?sslmode= da libpq vira o argumento ssl do asyncpg, que não conhece sslmode.
+SSL_MODES = ("disable", "allow", "prefer", "require", "verify-ca", "verify-full")
+LIBPQ_SSL_FILE_PARAMS = ("sslrootcert", "sslcert", "sslkey", "sslcrl", "sslpassword")
+
+ASYNC_DATABASE_URL = make_url(DATABASE_URL)
+DB_CONNECT_ARGS = {}
+if ASYNC_DATABASE_URL.get_backend_name() in ("postgres", "postgresql"):
+    ASYNC_DATABASE_URL = ASYNC_DATABASE_URL.set(drivername="postgresql+asyncpg")
+    unsupported = [name for name in LIBPQ_SSL_FILE_PARAMS if name in ASYNC_DATABASE_URL.query]
+    if unsupported:
+        logging.error(f"Parâmetros não suportados pelo asyncpg na DATABASE_URL: {', '.join(unsupported)}")
+        raise ValueError(
+            "Remova da DATABASE_URL os parâmetros de arquivo SSL da libpq "
+            f"({', '.join(unsupported)}) e use as variáveis PGSSLROOTCERT, PGSSLCERT, PGSSLKEY etc."
+        )
+    sslmode = ASYNC_DATABASE_URL.query.get("sslmode")
+    if sslmode is not None:
+        if sslmode not in SSL_MODES:
+            logging.error(f"sslmode inválido na DATABASE_URL: {sslmode}")
+            raise ValueError(f"sslmode deve ser um de: {', '.join(SSL_MODES)}.")
+        ASYNC_DATABASE_URL = ASYNC_DATABASE_URL.difference_update_query(["sslmode"])
+        DB_CONNECT_ARGS["ssl"] = sslmode
+# O pool é por worker do Uvicorn: o total de conexões é workers × (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=int(os.getenv("DB_POOL_SIZE", 5)),
+    max_overflow=int(os.getenv("DB_MAX_OVERFLOW", 10)),
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    connect_args=DB_CONNECT_ARGS,
+)
+SessionLocal = sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class TaskDB(Base):
     __tablename__ = "calculated_tasks"
     id = Column(Integer, primary_key=True, index=True)
-    description = Column(String, index=True)
+    description = Column(String)
     start_time = Column(DateTime)
     end_time = Column(DateTime)
     duration_hours = Column(Float)
     cost = Column(Float)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    # now() é renderizado no próprio INSERT (sem parâmetro por linha); o default do lado do cliente
+    # garante o valor mesmo em tabelas antigas que ainda não receberam o server_default
+    created_at = Column(DateTime(timezone=True), default=func.now(), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        # A listagem de tarefas ordena por start_time decrescente
+        Index("ix_tasks_start_time_desc", start_time.desc()),
+    )
+
+# Pares (consulta ao catálogo que indica se a alteração ainda falta, alteração). A consulta evita
+# pedir o lock ACCESS EXCLUSIVE do ALTER TABLE a cada inicialização quando nada precisa mudar.
+# Mantido em sincronia com a seção "Atualização do banco" do README
+CREATED_AT_COLUMN = (
+    "FROM information_schema.columns WHERE table_schema = current_schema() "
+    "AND table_name = 'calculated_tasks' AND column_name = 'created_at'"
+)
+SCHEMA_UPGRADES = (
+    (
+        f"SELECT data_type = 'timestamp without time zone' {CREATED_AT_COLUMN}",
+        # Os valores antigos vinham de datetime.utcnow(): são UTC sem fuso
+        "ALTER TABLE calculated_tasks ALTER COLUMN created_at TYPE timestamptz USING created_at AT TIME ZONE 'UTC'",
+    ),
+    (
+        f"SELECT column_default IS NULL {CREATED_AT_COLUMN}",
+        "ALTER TABLE calculated_tasks ALTER COLUMN created_at SET DEFAULT now()",
+    ),
+    (
+        "SELECT to_regclass('ix_tasks_start_time_desc') IS NULL",
+        "CREATE INDEX ix_tasks_start_time_desc ON calculated_tasks (start_time DESC)",
+    ),
+)
+
+async def init_db():
+    if not DB_AUTO_CREATE:
+        return
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # Com vários workers, um cria o schema e os demais aguardam o lock (liberado no fim
+            # da transação); depois disso o create_all deles só confirma que as tabelas existem
+            await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext('schema_init'))"))
+        await conn.run_sync(Base.metadata.create_all)
+        if conn.dialect.name == "postgresql":
+            # create_all não altera tabelas existentes: aplica o que foi adicionado depois
+            for pending_check, statement in SCHEMA_UPGRADES:
+                if await conn.scalar(text(pending_check)):
+                    logging.info(f"Atualizando schema: {statement}")
+                    await conn.execute(text(statement))
 
-Base.metadata.create_all(bind=engine)
+# Construído uma única vez e reaproveitado em todos os INSERTs em lote
+TASK_INSERT_STMT = insert(TaskDB)
 
 # --- Modelos de Dados Pydantic ---
 class TaskInput(BaseModel):
-    description: str = Field(..., example="Desenvolvimento do endpoint de autenticação")
-    start_time: datetime = Field(..., example="2024-01-10T09:00:00")
-    end_time: datetime = Field(..., example="2024-01-10T11:30:00")
+    description: str = Field(..., examples=["Desenvolvimento do endpoint de autenticação"])
+    start_time: datetime = Field(..., examples=["2024-01-10T09:00:00"])
+    end_time: datetime = Field(..., examples=["2024-01-10T11:30:00"])
 
 class CalculationRequest(BaseModel):
     tasks: List[TaskInput]
 
-    class Config:
-        schema_extra = {
+    model_config = ConfigDict(
+        json_schema_extra={
             "example": {
                 "tasks": [
                     {
@@ -85,6 +183,7 @@ class CalculationRequest(BaseModel):
                 ]
             }
         }
+    )
 
 class TaskOutput(TaskInput):
     duration_hours: float
@@ -104,17 +203,61 @@ class TaskListItem(BaseModel):
     hourly_rate: float
     created_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+# --- Cálculo de Custos ---
+def _as_naive_utc(value: datetime) -> datetime:
+    # start_time/end_time são "timestamp without time zone": o asyncpg rejeita datetimes com fuso
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+INVALID_INTERVAL_DETAIL = "A data de fim da tarefa '{}' deve ser posterior à data de início."
+
+def _compute_batch(starts, ends, hourly_rate):
+    """Calcula duração (horas) e custo de todas as tarefas.
+
+    Retorna (índice da primeira tarefa inválida ou None, durações, custos).
+    """
+    # Validação em uma única passada, antes de qualquer cálculo
+    for index, (start, end) in enumerate(zip(starts, ends)):
+        if end <= start:
+            return index, None, None
+    rate_per_second = hourly_rate / 3600.0
+    durations = []
+    costs = []
+    for start, end in zip(starts, ends):
+        seconds = (end - start).total_seconds()
+        durations.append(seconds / 3600.0)
+        costs.append(seconds * rate_per_second)
+    return None, durations, costs
+
+def _compute_costs(tasks: List[TaskInput]):
+    # Normalizar evita o TypeError ao comparar datetimes com e sem fuso na mesma requisição
+    starts = [_as_naive_utc(t.start_time) for t in tasks]
+    ends = [_as_naive_utc(t.end_time) for t in tasks]
+    invalid_index, durations, costs = _compute_batch(starts, ends, HOURLY_RATE)
+    if invalid_index is not None:
+        task = tasks[invalid_index]
+        raise HTTPException(status_code=400, detail=INVALID_INTERVAL_DETAIL.format(task.description))
+    return durations, costs
+
+# --- Dependências ---
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
 
 # --- Endpoints da API ---
 @app.get("/", summary="Endpoint de Health Check")
 def read_root():
-    return {"status": "ok"}
+    return ORJSONResponse({"status": "ok"})
 
 @app.post(
     "/api/calculate/",
-    response_model=CalculationResponse,
+    # Sem response_model: a resposta é montada aqui e não precisa ser revalidada;
+    # o schema continua documentado no OpenAPI via `responses`.
+    response_model=None,
+    responses={200: {"model": CalculationResponse}},
     summary="Calcula e salva tarefas",
     tags=["Tarefas"],
     description="""
@@ -134,24 +277,19 @@ Adiciona uma ou mais tarefas, calcula o valor de cada uma com base na duração
 ```
 """
 )
-def calculate_and_save_tasks(request: CalculationRequest):
+async def calculate_and_save_tasks(request: CalculationRequest, db: AsyncSession = Depends(get_db)):
     if not request.tasks:
         raise HTTPException(status_code=400, detail="A lista de tarefas não pode estar vazia.")
+    durations, costs = _compute_costs(request.tasks)
+    # Soma com arredondamento exato, sem acumular erro de ponto flutuante tarefa a tarefa
+    grand_total = math.fsum(costs)
     calculated_tasks_output = []
-    grand_total = 0.0
-    db = SessionLocal()
+    rows = []
     try:
-        for task in request.tasks:
-            if task.end_time <= task.start_time:
-                raise HTTPException(
-                    status_code=400, 
-                    detail=f"A data de fim da tarefa '{task.description}' deve ser posterior à data de início."
-                )
-            duration = task.end_time - task.start_time
-            duration_hours = duration.total_seconds() / 3600
-            cost = duration_hours * HOURLY_RATE
+        for task, duration_hours, cost in zip(request.tasks, durations, costs):
+            # Dados já validados em TaskInput: model_construct evita uma segunda validação
             calculated_tasks_output.append(
-                TaskOutput(
+                TaskOutput.model_construct(
                     description=task.description,
                     start_time=task.start_time,
                     end_time=task.end_time,
@@ -159,75 +297,150 @@ def calculate_and_save_tasks(request: CalculationRequest):
                     cost=cost,
                 )
             )
-            grand_total += cost
-            db_task = TaskDB(
-                description=task.description,
-                start_time=task.start_time,
-                end_time=task.end_time,
-                duration_hours=duration_hours,
-                cost=cost,
-            )
-            db.add(db_task)
-        db.commit()
+            rows.append({
+                "description": task.description,
+                "start_time": _as_naive_utc(task.start_time),
+                "end_time": _as_naive_utc(task.end_time),
+                "duration_hours": duration_hours,
+                "cost": cost,
+            })
+        # Uma única execução com todas as linhas (executemany do asyncpg) em vez de um flush do ORM por tarefa
+        await db.execute(TASK_INSERT_STMT, rows)
+        await db.commit()
         logging.info(f"{len(request.tasks)} tarefas calculadas e salvas. Valor total: {grand_total:.2f}")
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logging.error(f"Erro durante o cálculo e salvamento: {e}")
         raise HTTPException(status_code=500, detail="Ocorreu um erro interno ao processar as tarefas.")
-    finally:
-        db.close()
-    return CalculationResponse(
-        calculated_tasks=calculated_tasks_output,
-        grand_total=grand_total,
-    )
+    return ORJSONResponse({
+        "calculated_tasks": [t.model_dump() for t in calculated_tasks_output],
+        "grand_total": grand_total,
+    })
 
 @app.get(
     "/tasks",
-    response_model=List[TaskListItem],
+    response_model=None,
+    responses={200: {"model": List[TaskListItem]}},
     summary="Lista todas as tarefas salvas",
     tags=["Tarefas"]
 )
-def list_tasks():
+async def list_tasks(
+    limit: Optional[int] = Query(None, ge=1, description="Quantidade máxima de tarefas retornadas (padrão: todas)"),
+    offset: int = Query(0, ge=0, description="Quantidade de tarefas a pular"),
+):
+    # Projeção só das colunas necessárias: linhas Core, sem hidratar objetos ORM
+    query = (
+        select(
+            TaskDB.id,
+            TaskDB.description,
+            TaskDB.start_time,
+            TaskDB.end_time,
+            TaskDB.duration_hours,
+            TaskDB.cost,
+            TaskDB.created_at,
+        )
+        .order_by(TaskDB.start_time.desc())
+        .offset(offset)
+        .limit(limit)
+    )
+    # A consulta é executada antes de devolver a resposta: falhas de conexão ou de SQL ainda
+    # viram 500, em vez de um 200 com JSON vazio depois que os cabeçalhos já foram enviados.
     db = SessionLocal()
     try:
-        tasks = db.query(TaskDB).order_by(TaskDB.start_time.desc()).all()
-        result = []
-        for t in tasks:
-            result.append({
-                "id": t.id,
-                "description": t.description,
-                "start_time": t.start_time,
-                "end_time": t.end_time,
-                "duration_hours": t.duration_hours,
-                "calculated_value": t.cost,
-                "hourly_rate": HOURLY_RATE,
-                "created_at": t.created_at,
-            })
-        return result
+        result = await db.stream(query.execution_options(yield_per=1000))
+    except Exception as e:
+        await _close_session(db)
+        logging.error(f"Erro ao listar tarefas: {e}")
+        raise HTTPException(status_code=500, detail="Erro ao listar tarefas.")
+    # O background fecha a sessão mesmo se o cliente desconectar antes do gerador começar
+    return StreamingResponse(
+        _stream_tasks(db, result),
+        media_type="application/json",
+        background=BackgroundTask(_close_session, db),
+    )
+
+async def _close_session(db):
+    # Protegido contra o cancelamento que o Starlette aplica quando o cliente aborta o download;
+    # fechar uma sessão já fechada não faz nada, então pode ser chamado mais de uma vez
+    with anyio.CancelScope(shield=True):
+        await db.close()
+
+async def _stream_tasks(db, result):
+    # Serializa as tarefas em lotes para não manter a tabela inteira em memória.
+    # A sessão é fechada aqui (e não via get_db) porque precisa seguir aberta durante o envio.
+    hourly_rate = HOURLY_RATE
+    try:
+        yield b"["
+        first = True
+        async for partition in result.partitions():
+            items = [
+                {
+                    "id": r.id,
+                    "description": r.description,
+                    "start_time": r.start_time,
+                    "end_time": r.end_time,
+                    "duration_hours": r.duration_hours,
+                    "calculated_value": r.cost,
+                    "hourly_rate": hourly_rate,
+                    "created_at": r.created_at,
+                }
+                for r in partition
+            ]
+            yield (b"" if first else b",") + orjson.dumps(items)[1:-1]
+            first = False
+        yield b"]"
     finally:
-        db.close()
+        await _close_session(db)
 
 @app.delete(
     "/tasks/{task_id}",
     summary="Remove uma tarefa pelo ID",
     tags=["Tarefas"]
 )
-def delete_task(task_id: int = Path(..., description="ID da tarefa a ser removida")):
-    db = SessionLocal()
+async def delete_task(
+    task_id: int = Path(..., description="ID da tarefa a ser removida"),
+    db: AsyncSession = Depends(get_db),
+):
     try:
-        task = db.query(TaskDB).filter(TaskDB.id == task_id).first()
-        if not task:
-            raise HTTPException(status_code=404, detail="Tarefa não encontrada.")
-        db.delete(task)
-        db.commit()
-        logging.info(f"Tarefa {task_id} removida com sucesso.")
-        return {"detail": "Tarefa removida com sucesso."}
+        # DELETE ... RETURNING: remove e confirma a existência em uma única ida ao banco
+        result = await db.execute(
+            delete(TaskDB)
+            .where(TaskDB.id == task_id)
+            .returning(TaskDB.id)
+            .execution_options(synchronize_session=False)
+        )
+        deleted_id = result.scalar_one_or_none()
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logging.error(f"Erro ao remover tarefa: {e}")
         raise HTTPException(status_code=500, detail="Erro ao remover tarefa.")
-    finally:
-        db.close()
+    if deleted_id is None:
+        raise HTTPException(status_code=404, detail="Tarefa não encontrada.")
+    logging.info(f"Tarefa {task_id} removida com sucesso.")
+    return ORJSONResponse({"detail": "Tarefa removida com sucesso."})
 
 # --- Configuração de Métricas para Prometheus ---
-Instrumentator().instrument(app).expose(app, endpoint="/metrics")
\ No newline at end of file
+Instrumentator().instrument(app)
+
+# Com vários workers do Uvicorn (PROMETHEUS_MULTIPROC_DIR definido), agrega as métricas de
+# todos os processos, como faz o Instrumentator.expose()
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    METRICS_REGISTRY = CollectorRegistry()
+    multiprocess.MultiProcessCollector(METRICS_REGISTRY)
+else:
+    METRICS_REGISTRY = REGISTRY
+
+# Cache curto da exposição: vários scrapes dentro do TTL reaproveitam o mesmo payload
+METRICS_CACHE_TTL = float(os.getenv("METRICS_CACHE_TTL", 1.0))
+_metrics_cache = (float("-inf"), b"")
+
+@app.get("/metrics", summary="Métricas para o Prometheus")
+def metrics():
+    global _metrics_cache
+    rendered_at, payload = _metrics_cache
+    now = time.monotonic()
+    if now - rendered_at >= METRICS_CACHE_TTL:
+        payload = generate_latest(METRICS_REGISTRY)
+        _metrics_cache = (now, payload)
+    return Response(payload, media_type=CONTENT_TYPE_LATEST)
\ No newline at end of file